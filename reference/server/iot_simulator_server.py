@@ -1,25 +1,31 @@
-import os, base64, dotenv
+import os, base64, dotenv, hmac, hashlib, logging, socket, time
 import sys
 from datetime import datetime
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Request, status, Depends
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict
+from typing import Any, Dict
 # use application logger from utils.applogging
 import sqlalchemy as sa
 import uvicorn
 from sqlalchemy.ext.asyncio import AsyncSession
 from utils.applogging import setup_logging
 from utils.dbconnection import DeviceId, lifespan, get_db, AsyncSession
-from utils.device import generate_symmetric_key, generate_device_credentials, generate_device_credential, delete_device_credential
+from utils.device import generate_symmetric_key, generate_device_credentials, delete_device_credential
 from utils.message_envelope import MessageEnvelope
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import JSONResponse
+from utils.urandom_pool import urandom
+from starlette.responses import JSONResponse, Response
 import threading
 from azure.eventhub import EventHubConsumerClient
+from azure.iot.hub import IoTHubRegistryManager
+from azure.iot.hub.models import AuthenticationMechanism, ExportImportDevice, SymmetricKey
 import json
+import orjson
+import msgspec
 import asyncio
+import redis.asyncio as aioredis
 from concurrent.futures import Future
+from contextlib import asynccontextmanager
 
 dotenv.load_dotenv()
 
@@ -30,53 +36,276 @@ logger = setup_logging()
 initialRetryTimeout = 30
 maxRetry = 10
 messageIntervalSeconds = 5
+broadcastSendTimeout = 1.0  # seconds a single client may take to accept a broadcast frame
+telemetryBatchSize = 500  # max reports written per INSERT batch
+telemetryFlushInterval = 0.1  # seconds to wait for a batch to fill before flushing
+telemetryQueueMaxSize = 10000  # /report blocks (backpressure) once this many reports are pending
+redisMaxBackoff = 30.0  # seconds between Redis resubscribe attempts, at most
+
+# Redis pub/sub fan-out so commands reach sockets held by any uvicorn worker.
+# Opt-in: without REDIS_URL the server keeps all state in-process (single worker only).
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_BROADCAST_CHANNEL = "iotsim:broadcast"
+REDIS_COMMAND_CHANNEL_PREFIX = "iotsim:command:"  # + client uuid
+REDIS_WORKERS_KEY = "iotsim:workers"  # sorted set: worker id -> last heartbeat (epoch seconds)
+REDIS_CLIENTS_KEY_PREFIX = "iotsim:clients:"  # + worker id: set of client uuids held by that worker
+REDIS_HEARTBEAT_INTERVAL = 10  # seconds between worker heartbeats / client set resyncs
+REDIS_WORKER_TTL = 30  # a worker (and its client set) missing heartbeats this long is considered gone
+# uvicorn spawns (not forks) its workers, so each worker process computes its own id
+REDIS_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}"
+REDIS_WORKER_CLIENTS_KEY = REDIS_CLIENTS_KEY_PREFIX + REDIS_WORKER_ID
+redis_client: aioredis.Redis | None = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
 
 # Generate 32byte base64 random uuid (defined early so it's available where needed)
 def generate_uuid() -> str:
-    return base64.urlsafe_b64encode(os.urandom(32)).rstrip(b'=').decode('utf-8')
+    return base64.urlsafe_b64encode(urandom(32)).rstrip(b'=').decode('utf-8')
+
+# IoT Hub host name and device key, parsed once from env (fails fast at startup if missing)
+IOT_HOST_NAME = os.environ["IOT_CONNECTION_STRING"].split(";", 1)[0].split("=", 1)[1]
+IOT_PRIMARY_KEY_DEVICE = os.environ["IOT_PRIMARY_KEY_DEVICE"]
+IOT_SECONDARY_KEY_DEVICE = os.getenv("IOT_SECONDARY_KEY_DEVICE") or IOT_PRIMARY_KEY_DEVICE
+IOT_BULK_MAX_DEVICES = 100  # IoT Hub accepts at most 100 devices per bulk registry call
+IOT_MAX_CONCURRENT_REQUESTS = 32  # cap on parallel IoT Hub registry calls per endpoint
+
+registry_manager = IoTHubRegistryManager.from_connection_string(os.environ["IOT_CONNECTION_STRING"])
 
 # Generate IoTHub Connection String from env
 def generate_iothub_connection_string(device_id: str) -> str:
-    host_name = os.getenv("IOT_CONNECTION_STRING").split(";")[0].split("=")[1]
-    shared_access_key = os.getenv("IOT_PRIMARY_KEY_DEVICE")
-    return f"HostName={host_name};DeviceId={device_id};SharedAccessKey={shared_access_key}"
+    return f"HostName={IOT_HOST_NAME};DeviceId={device_id};SharedAccessKey={IOT_PRIMARY_KEY_DEVICE}"
+
+# Register up to IOT_BULK_MAX_DEVICES devices in IoT Hub with the shared device keys in one HTTP call
+def create_devices_chunk(device_ids: list[str]):
+    devices = [
+        ExportImportDevice(
+            id=device_id,
+            status="enabled",
+            import_mode="create",
+            authentication=AuthenticationMechanism(
+                type="sas",
+                symmetric_key=SymmetricKey(primary_key=IOT_PRIMARY_KEY_DEVICE, secondary_key=IOT_SECONDARY_KEY_DEVICE),
+            ),
+        )
+        for device_id in device_ids
+    ]
+    result = registry_manager.bulk_create_or_update_devices(devices)
+    # devices already registered in IoT Hub keep their registration; generate_devices skips their existing DB rows
+    errors = [e for e in (result.errors or []) if e.error_code != "DeviceAlreadyExists"]
+    if errors:
+        raise RuntimeError("; ".join(f"{e.device_id}: {e.error_code} {e.error_status}" for e in errors))
+
+# Register any number of devices, running at most IOT_MAX_CONCURRENT_REQUESTS bulk calls at once
+async def create_devices_bulk(device_ids: list[str]):
+    sem = asyncio.Semaphore(IOT_MAX_CONCURRENT_REQUESTS)
+
+    async def create_chunk(chunk: list[str]):
+        async with sem:
+            await asyncio.to_thread(create_devices_chunk, chunk)
+
+    results = await asyncio.gather(
+        *(create_chunk(device_ids[i:i + IOT_BULK_MAX_DEVICES]) for i in range(0, len(device_ids), IOT_BULK_MAX_DEVICES)),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib json encoder."""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS)
+
+
+# Hot-path SQL, built once at import instead of per request so SQLAlchemy's compiled cache
+# and the driver's prepared-statement cache see the same statement object every time
+INSERT_TELEMETRY_SQL = sa.text(
+    "INSERT INTO telemetries (deviceid, type, modelid, status, temp, humidity, ts) "
+    "VALUES (:device_id, :type, :modelid, :status, :temp, :humidity, :ts)"
+)
+CLAIM_DEVICE_ID_SQL = sa.text(
+    "UPDATE deviceids SET device_uuid = :message_id WHERE device_id = ("
+    "SELECT device_id FROM deviceids WHERE device_uuid IS NULL ORDER BY device_id ASC LIMIT 1 FOR UPDATE SKIP LOCKED"
+    ") RETURNING device_id"
+)
+CLEAR_MAPPINGS_SQL = sa.text("UPDATE deviceids SET device_uuid = NULL")
+
+# get_db is a FastAPI dependency generator; wrap it so background tasks can open sessions too
+db_session = asynccontextmanager(get_db)
+
+# Reports posted to /report are queued here and written in batches by telemetry_writer.
+# None is the shutdown sentinel: the writer saves the batch it holds and exits.
+telemetry_queue: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=telemetryQueueMaxSize)
+
+
+def is_row_error(e: Exception) -> bool:
+    """True if the INSERT failed because of the data itself rather than the connection."""
+    if isinstance(e, (sa.exc.IntegrityError, sa.exc.DataError)):
+        return True
+    return (
+        isinstance(e, sa.exc.DBAPIError)
+        and not e.connection_invalidated
+        and not isinstance(e, (sa.exc.OperationalError, sa.exc.InterfaceError))
+    )
+
+
+async def flush_telemetries(rows: list[dict]):
+    async with db_session() as db:
+        try:
+            await db.execute(INSERT_TELEMETRY_SQL, rows)
+            await db.commit()
+            logger.info("Saved %d reports to telemetries table", len(rows))
+            return
+        except Exception as e:
+            await db.rollback()
+            if not is_row_error(e):
+                # retrying row by row against a broken connection would stall the writer for every row
+                logger.error("Error saving %d reports to telemetries table, dropping batch: %s", len(rows), e)
+                return
+            if len(rows) == 1:
+                logger.error("Error saving report from %s to telemetries table: %s", rows[0]["device_id"], e)
+                return
+            logger.warning("Error saving %d reports to telemetries table, retrying one by one: %s", len(rows), e)
+        # one bad report must not cost the rest of the batch
+        saved = 0
+        for i, row in enumerate(rows):
+            try:
+                await db.execute(INSERT_TELEMETRY_SQL, row)
+                await db.commit()
+                saved += 1
+            except Exception as e:
+                await db.rollback()
+                if not is_row_error(e):
+                    logger.error("Error saving reports to telemetries table, dropping remaining %d: %s", len(rows) - i, e)
+                    break
+                logger.error("Error saving report from %s to telemetries table: %s", row["device_id"], e)
+        logger.info("Saved %d of %d reports to telemetries table", saved, len(rows))
+
+
+async def telemetry_writer():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await telemetry_queue.get()
+        if row is None:
+            break
+        rows = [row]
+        deadline = loop.time() + telemetryFlushInterval
+        # collect up to telemetryBatchSize rows or until telemetryFlushInterval elapses
+        while len(rows) < telemetryBatchSize:
+            try:
+                row = telemetry_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(telemetry_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if row is None:
+                stopping = True
+                break
+            rows.append(row)
+        # keep the writer alive through DB outages; otherwise /report would block once the queue fills
+        try:
+            await flush_telemetries(rows)
+        except Exception:
+            logger.exception("Telemetry writer failed to save %d reports", len(rows))
+
+
+async def stop_task(task: asyncio.Task | None, name: str):
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.exception("%s task had failed before shutdown", name)
+
+
+@asynccontextmanager
+async def app_lifespan(app: FastAPI):
+    async with lifespan(app):
+        writer = asyncio.create_task(telemetry_writer())
+        subscriber = asyncio.create_task(command_subscriber()) if redis_client else None
+        heartbeat = asyncio.create_task(redis_heartbeat()) if redis_client else None
+        try:
+            yield
+        finally:
+            # let the writer save the batch it is holding and everything queued before the sentinel
+            if not writer.done():
+                await telemetry_queue.put(None)
+            try:
+                await writer
+            except Exception:
+                logger.exception("Telemetry writer had failed before shutdown")
+            await stop_task(subscriber, "Redis command subscriber")
+            await stop_task(heartbeat, "Redis heartbeat")
+            if redis_client:
+                try:
+                    # this worker's sockets are going away with it
+                    await redis_client.delete(REDIS_WORKER_CLIENTS_KEY)
+                    await redis_client.zrem(REDIS_WORKERS_KEY, REDIS_WORKER_ID)
+                    await redis_client.aclose()
+                except Exception:
+                    logger.exception("Error cleaning up Redis state on shutdown")
+            # write whatever was queued after the sentinel (or everything, if the writer died)
+            pending = []
+            while not telemetry_queue.empty():
+                row = telemetry_queue.get_nowait()
+                if row is not None:
+                    pending.append(row)
+            for i in range(0, len(pending), telemetryBatchSize):
+                try:
+                    await flush_telemetries(pending[i:i + telemetryBatchSize])
+                except Exception:
+                    logger.exception("Error saving %d pending reports on shutdown", len(pending[i:i + telemetryBatchSize]))
+
+
 app = FastAPI(
     title="IoT Simulator Server",
     description="IoT 시뮬레이터 클라이언트와 통신하는 서버",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=app_lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Bearer token for simple auth (set in environment)
 API_BEARER_TOKEN = os.getenv("API_BEARER_TOKEN")
+API_BEARER_TOKEN_BYTES = (API_BEARER_TOKEN or "").encode()
 
 
-class BearerAuthMiddleware(BaseHTTPMiddleware):
+class BearerAuthMiddleware:
     """Simple middleware that enforces a single shared Bearer token for HTTP requests.
 
     Exempt paths (health/docs/openapi) are allowed without a token for convenience.
+    Written as a plain ASGI app rather than a BaseHTTPMiddleware so requests are not
+    pumped through an extra task and memory stream.
     """
     def __init__(self, app, exempt_paths: set[str] | None = None):
-        super().__init__(app)
+        self.app = app
         self.exempt_paths = exempt_paths or {"/api/health", "/docs", "/openapi.json", "/redoc"}
 
-    async def dispatch(self, request, call_next):
-        # If no token configured, allow requests (make auth opt-in)
-        if not API_BEARER_TOKEN:
-            return await call_next(request)
-
-        path = request.url.path
-        if path in self.exempt_paths:
-            return await call_next(request)
-
-        auth = request.headers.get("authorization")
-        if not auth or not auth.lower().startswith("bearer "):
-            return JSONResponse({"detail": "Missing or invalid Authorization header"}, status_code=401)
-        token = auth.split(" ", 1)[1]
-        if token != API_BEARER_TOKEN:
-            return JSONResponse({"detail": "Invalid token"}, status_code=403)
-
-        return await call_next(request)
+    async def __call__(self, scope, receive, send):
+        # If no token configured, allow requests (make auth opt-in).
+        # WebSocket connections check the token in websocket_endpoint.
+        if scope["type"] != "http" or not API_BEARER_TOKEN or scope["path"] in self.exempt_paths:
+            return await self.app(scope, receive, send)
+
+        auth = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                auth = value
+                break
+        if not auth or auth[:7].lower() != b"bearer ":
+            response = ORJSONResponse({"detail": "Missing or invalid Authorization header"}, status_code=401)
+        elif not hmac.compare_digest(auth[7:], API_BEARER_TOKEN_BYTES):
+            response = ORJSONResponse({"detail": "Invalid token"}, status_code=403)
+        else:
+            return await self.app(scope, receive, send)
+        await response(scope, receive, send)
 
 
 # register middleware
@@ -89,39 +318,232 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# WebSocket subprotocol for MessagePack frames; clients that don't request it get JSON text frames
+MSGPACK_SUBPROTOCOL = "msgpack.v1"
+
+# Send an envelope in the wire format the client negotiated
+async def send_envelope(websocket: WebSocket, envelope: MessageEnvelope, use_msgpack: bool):
+    if use_msgpack:
+        await websocket.send_bytes(envelope.to_msgpack())
+    else:
+        await websocket.send_text(envelope.to_json())
+
 # 클라이언트 연결 관리
 class ConnectionManager:
+    """Sockets connected to this worker.
+
+    send_command/broadcast publish through Redis when REDIS_URL is set so every
+    worker delivers to its own sockets; otherwise they deliver locally.
+    """
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {} # uuid: WebSocket
-    async def connect(self, uuid: str, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[uuid] = websocket
-        
-    def disconnect(self, uuid: str):
-        self.active_connections.pop(uuid, None)
+        # parallel arrays: _ws[i] is the socket of client _uuid[i]; _idx maps uuid -> i
+        self._ws: list[WebSocket] = []
+        self._uuid: list[str] = []
+        self._idx: Dict[str, int] = {}
+        # bumped whenever the set of uuids changes; keys the cached /clients response
+        self._version = 0
+        self._etag_prefix = os.urandom(4).hex()  # keeps ETags from matching across restarts
+        self._clients_cache: tuple[str, bytes] | None = None
+        self.msgpack_clients: set[str] = set() # uuids that negotiated MSGPACK_SUBPROTOCOL
+    async def connect(self, uuid: str, websocket: WebSocket, subprotocol: str | None = None):
+        await websocket.accept(subprotocol=subprotocol)
+        i = self._idx.get(uuid)
+        if i is None:
+            self._idx[uuid] = len(self._uuid)
+            self._uuid.append(uuid)
+            self._ws.append(websocket)
+            self._version += 1
+            self._clients_cache = None
+        else:
+            # reconnect under the same uuid replaces the old socket
+            self._ws[i] = websocket
+        if subprotocol == MSGPACK_SUBPROTOCOL:
+            self.msgpack_clients.add(uuid)
+        else:
+            self.msgpack_clients.discard(uuid)
+        if redis_client:
+            try:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    pipe.sadd(REDIS_WORKER_CLIENTS_KEY, uuid)
+                    pipe.expire(REDIS_WORKER_CLIENTS_KEY, REDIS_WORKER_TTL)
+                    await pipe.execute()
+            except Exception:
+                # the next heartbeat resyncs this worker's set
+                logger.exception("Failed to register %s in Redis", uuid)
+
+    async def disconnect(self, uuid: str):
+        self.msgpack_clients.discard(uuid)
+        if self._remove(uuid) and redis_client:
+            try:
+                # only this worker's set: a reconnect on another worker stays listed
+                await redis_client.srem(REDIS_WORKER_CLIENTS_KEY, uuid)
+            except Exception:
+                logger.exception("Failed to deregister %s in Redis", uuid)
+
+    def _remove(self, uuid: str) -> bool:
+        # swap the last entry into the freed slot so removal stays O(1)
+        i = self._idx.pop(uuid, None)
+        if i is None:
+            return False
+        self._version += 1
+        self._clients_cache = None
+        last_uuid = self._uuid.pop()
+        last_ws = self._ws.pop()
+        if last_uuid != uuid:
+            self._uuid[i] = last_uuid
+            self._ws[i] = last_ws
+            self._idx[last_uuid] = i
+        return True
+
+    def get(self, uuid: str) -> WebSocket | None:
+        i = self._idx.get(uuid)
+        return None if i is None else self._ws[i]
+
+    def local_ids(self) -> list[str]:
+        # the live registry list, not a copy; callers must not mutate it
+        return self._uuid
+
+    async def client_ids(self) -> list[str]:
+        if redis_client:
+            # union of the client sets of workers that heartbeated within REDIS_WORKER_TTL
+            workers = await redis_client.zrangebyscore(REDIS_WORKERS_KEY, time.time() - REDIS_WORKER_TTL, "+inf")
+            if not workers:
+                return []
+            return sorted(await redis_client.sunion([REDIS_CLIENTS_KEY_PREFIX + w for w in workers]))
+        return self.local_ids()
+
+    async def clients_response(self) -> tuple[str, bytes]:
+        """(ETag, JSON body) for /clients, re-encoded only when the client set changes."""
+        if redis_client:
+            # the set is shared across workers, so there is no local version to key on
+            body = orjson.dumps({"connected_clients": await self.client_ids()})
+            return f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"', body
+        if self._clients_cache is None:
+            body = orjson.dumps({"connected_clients": self._uuid})
+            self._clients_cache = (f'"{self._etag_prefix}-{self._version}"', body)
+        return self._clients_cache
 
     async def send_command(self, uuid: str, command: dict):
-        ws = self.active_connections.get(uuid)
+        frame = orjson.dumps(command).decode()
+        if redis_client:
+            await redis_client.publish(REDIS_COMMAND_CHANNEL_PREFIX + uuid, frame)
+        else:
+            await self.send_local(uuid, frame)
+
+    async def send_local(self, uuid: str, frame: str):
+        ws = self.get(uuid)
         if ws:
             try:
-                await ws.send_json(command)
+                if uuid in self.msgpack_clients:
+                    await ws.send_bytes(msgspec.msgpack.encode(orjson.loads(frame)))
+                else:
+                    await ws.send_text(frame)
             except Exception:
                 logger.exception("Failed to send command to %s; disconnecting", uuid)
-                self.disconnect(uuid)
+                await self.disconnect(uuid)
 
     async def broadcast(self, command: dict):
-        # iterate over a static list of items to avoid runtime dict size changes
-        for uuid, ws in list(self.active_connections.items()):
-            try:
-                await ws.send_json(command)
-                logger.info("Broadcast command sent to %s", uuid)
-            except Exception:
-                # Log and remove the dead connection, but continue broadcasting to others
-                logger.exception("Failed to broadcast to %s; removing connection", uuid)
-                self.disconnect(uuid)
+        # serialize once and reuse the same text frame for every connection
+        frame = orjson.dumps(command).decode()
+        if redis_client:
+            await redis_client.publish(REDIS_BROADCAST_CHANNEL, frame)
+        else:
+            await self.broadcast_local(frame)
+
+    async def broadcast_local(self, frame: str):
+        # snapshot the arrays so connects/disconnects can happen while sends are in flight
+        uuids = self._uuid[:]
+        sockets = self._ws[:]
+        # MessagePack clients get the same command re-encoded once
+        msgpack_frame = msgspec.msgpack.encode(orjson.loads(frame)) if self.msgpack_clients else None
+        # send concurrently so a slow client doesn't hold up the others
+        results = await asyncio.gather(
+            *(
+                asyncio.wait_for(
+                    ws.send_bytes(msgpack_frame) if uuid in self.msgpack_clients else ws.send_text(frame),
+                    timeout=broadcastSendTimeout,
+                )
+                for uuid, ws in zip(uuids, sockets)
+            ),
+            return_exceptions=True,
+        )
+        for uuid, ws, result in zip(uuids, sockets, results):
+            if isinstance(result, asyncio.TimeoutError):
+                # The send was cancelled mid-frame, so the stream can't be trusted any more.
+                # Close it (1013 = try again later) so the device reconnects instead of being
+                # left connected but unregistered.
+                logger.warning("Broadcast to %s timed out; closing connection", uuid)
+                if self.get(uuid) is ws:
+                    await self.disconnect(uuid)
+                try:
+                    await asyncio.wait_for(ws.close(code=1013), timeout=broadcastSendTimeout)
+                except Exception:
+                    logger.debug("Closing slow connection %s failed", uuid, exc_info=True)
+            elif isinstance(result, BaseException):
+                # Log and remove the dead connection (unless it reconnected meanwhile)
+                logger.error("Failed to broadcast to %s; removing connection", uuid, exc_info=result)
+                if self.get(uuid) is ws:
+                    await self.disconnect(uuid)
+            else:
+                logger.debug("Broadcast command sent to %s", uuid)
 
 # 연결 관리자 인스턴스
 manager = ConnectionManager()
+
+
+async def redis_heartbeat():
+    """Advertise this worker and rewrite its client set from the local registry.
+
+    The set expires REDIS_WORKER_TTL after the last heartbeat, so a worker that
+    dies without cleaning up drops out of /clients on its own.
+    """
+    while True:
+        try:
+            now = time.time()
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.delete(REDIS_WORKER_CLIENTS_KEY)
+                if manager.local_ids():
+                    pipe.sadd(REDIS_WORKER_CLIENTS_KEY, *manager.local_ids())
+                pipe.expire(REDIS_WORKER_CLIENTS_KEY, REDIS_WORKER_TTL)
+                pipe.zadd(REDIS_WORKERS_KEY, {REDIS_WORKER_ID: now})
+                pipe.zremrangebyscore(REDIS_WORKERS_KEY, "-inf", now - REDIS_WORKER_TTL)
+                await pipe.execute()
+        except Exception:
+            logger.exception("Redis heartbeat failed")
+        await asyncio.sleep(REDIS_HEARTBEAT_INTERVAL)
+
+
+async def command_subscriber():
+    """Deliver commands published by any worker to the sockets held by this one.
+
+    Resubscribes with exponential backoff whenever the Redis connection drops.
+    """
+    backoff = 1.0
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(REDIS_BROADCAST_CHANNEL)
+            await pubsub.psubscribe(REDIS_COMMAND_CHANNEL_PREFIX + "*")
+            backoff = 1.0
+            async for message in pubsub.listen():
+                try:
+                    if message["type"] == "message":
+                        await manager.broadcast_local(message["data"])
+                    elif message["type"] == "pmessage":
+                        uuid = message["channel"][len(REDIS_COMMAND_CHANNEL_PREFIX):]
+                        await manager.send_local(uuid, message["data"])
+                except Exception:
+                    logger.exception("Failed to deliver command from channel %s", message.get("channel"))
+        except Exception:
+            logger.exception("Redis command subscription lost; resubscribing in %.0fs", backoff)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, redisMaxBackoff)
+
 @app.websocket("/ws/{uuid}")
 async def websocket_endpoint(websocket: WebSocket, uuid: str, db: AsyncSession = Depends(get_db)):
     # WebSocket auth: allow token via Authorization header or ?token=<token> query param
@@ -133,44 +555,67 @@ async def websocket_endpoint(websocket: WebSocket, uuid: str, db: AsyncSession =
         else:
             # fallback to query param
             token = websocket.query_params.get("token")
-        if token != API_BEARER_TOKEN:
+        if not hmac.compare_digest((token or "").encode(), API_BEARER_TOKEN_BYTES):
             await websocket.close(code=1008)
             return
-    await manager.connect(uuid, websocket)
+    use_msgpack = MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", ())
+    await manager.connect(uuid, websocket, MSGPACK_SUBPROTOCOL if use_msgpack else None)
     try:
         while True:
-            data = await websocket.receive_json()
-            logger.info(
-                "Received message from %s: Type: %s, Id: %s, Correlation_Id: %s, Action: %s, payload: %s, status: %s",
-                uuid,
-                data.get("type", ""),
-                data.get("id", ""),
-                data.get("correlationId", ""),
-                data.get("action", ""),
-                data.get("payload", {}),
-                data.get("status", "")
-            )
-            if "type" in data and data["type"] == "request":
+            try:
+                if use_msgpack:
+                    data = msgspec.msgpack.decode(await websocket.receive_bytes())
+                else:
+                    data = orjson.loads(await websocket.receive_text())
+            except KeyError:
+                # Starlette raises KeyError when the frame type doesn't match the negotiated format
+                logger.warning("Unexpected frame type from %s; closing", uuid)
+                await websocket.close(code=1003)  # unsupported data
+                break
+            except (msgspec.DecodeError, orjson.JSONDecodeError):
+                logger.warning("Undecodable message from %s; closing", uuid)
+                await websocket.close(code=1007)  # invalid payload data
+                break
+            if not isinstance(data, dict):
+                logger.warning("Non-object message from %s; closing", uuid)
+                await websocket.close(code=1007)
+                break
+            # read the fields used below once per message
+            message_type = data.get("type")
+            message_id = data.get("id", "")
+            action = data.get("action", "unknown")
+            # payload/meta only go to DEBUG; skip building the INFO args entirely when it's disabled
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Received message from %s: Type: %s, Id: %s, Correlation_Id: %s, Action: %s, status: %s",
+                    uuid,
+                    message_type or "",
+                    message_id,
+                    data.get("correlationId", ""),
+                    action,
+                    data.get("status", "")
+                )
+            if message_type == "request":
                 # Create a logic to handle acquire type message and generate a response.
-                logger.info("Received from %s: %s", uuid, data)
+                logger.debug("Received from %s: %s", uuid, data)
                 # 클라이언트가 서버로 상태/결과를 보낼 때 처리
                 # assign_device_id requires DB access via dependency injection; for websocket usage
                 # call it and handle DB/HTTP exceptions locally so ASGI doesn't see an HTTP response
                 try:
-                    assigned_device_id = await assign_device_id(data.get("id", ""), db)
+                    assigned_device_id = await assign_device_id(message_id, db)
                 except HTTPException as he:
                     # Send an error envelope back to the client and continue listening
                     envelope = MessageEnvelope(
-                        action=data.get("action", "unknown"),
+                        action=action,
                         type="error",
                         id=generate_uuid(),
-                        correlation_id=data.get("id", ""),
+                        correlationId=message_id,
                         payload={},
                         status="failure",
                         meta={"http_detail": he.detail, "http_status": he.status_code},
                     )
                     try:
-                        await websocket.send_json(envelope.to_dict())
+                        await send_envelope(websocket, envelope, use_msgpack)
                     except Exception:
                         # If sending fails, break the loop to let disconnect handling run
                         logger.exception("Failed to send error envelope to %s", uuid)
@@ -179,16 +624,16 @@ async def websocket_endpoint(websocket: WebSocket, uuid: str, db: AsyncSession =
                     continue
                 except Exception as e:
                     envelope = MessageEnvelope(
-                        action=data.get("action", "unknown"),
+                        action=action,
                         type="error",
                         id=generate_uuid(),
-                        correlation_id=data.get("id", ""),
+                        correlationId=message_id,
                         payload={},
                         status="failure",
                         meta={"error": str(e)},
                     )
                     try:
-                        await websocket.send_json(envelope.to_dict())
+                        await send_envelope(websocket, envelope, use_msgpack)
                     except Exception:
                         logger.exception("Failed to send internal error envelope to %s", uuid)
                         break
@@ -198,7 +643,7 @@ async def websocket_endpoint(websocket: WebSocket, uuid: str, db: AsyncSession =
                     version=1,
                     type="response",
                     id=generate_uuid(),
-                    correlationId=data.get("id", ""),
+                    correlationId=message_id,
                     action="device.config.update",
                     payload={
                         "device_id": assigned_device_id, 
@@ -209,83 +654,81 @@ async def websocket_endpoint(websocket: WebSocket, uuid: str, db: AsyncSession =
                         },
                     status="success",
                 )
-                await websocket.send_json(envelope.to_dict())
+                await send_envelope(websocket, envelope, use_msgpack)
+                # payload carries the device connection string, so it is never logged
                 logger.info(
-                    "Sent message Type: %s, Id: %s, Correlation_Id: %s, Action: %s, payload: %s, status: %s",
-                    envelope.type, envelope.id, envelope.correlationId, envelope.action, envelope.payload, envelope.status
+                    "Sent message Type: %s, Id: %s, Correlation_Id: %s, Action: %s, status: %s",
+                    envelope.type, envelope.id, envelope.correlationId, envelope.action, envelope.status
                 )
                 # 필요시 DB 저장 등 추가
-            if "type" in data and data["type"] == "report":
+            elif message_type == "report":
                 envelope = MessageEnvelope(
                     version=1,
                     type="response",
                     action="none",
                     id=generate_uuid(),
-                    correlationId=data.get("id", ""),
+                    correlationId=message_id,
                     status="received",
                 )
-                await websocket.send_json(envelope.to_dict())
+                await send_envelope(websocket, envelope, use_msgpack)
                 # DB에 저장 할까? 해야 하나?
                 logger.info("Report received send to %s with %s : %s", envelope.correlationId, envelope.type, envelope.status)
                 
     except WebSocketDisconnect:
-        manager.disconnect(uuid)
         logger.info("%s disconnected", uuid)
+    finally:
+        # however the loop ended, drop the registration unless a newer socket already took the uuid
+        if manager.get(uuid) is websocket:
+            await manager.disconnect(uuid)
                 # 필요시 DB 저장 등 추가
 
 @app.post("/generate_device/{number_of_devices}", status_code=status.HTTP_201_CREATED)
 async def generate_devices(number_of_devices: int, db: AsyncSession = Depends(get_db)):
-    device_ids = []
-    for i in range(number_of_devices):
-        device_id = f"simdevice{(i+1):04d}"
-        try:
-            generated = generate_device_credential(device_id)
-            device_ids.append(generated)
-            logger.info("Generated device %s in Azure, IoT Hub", device_id)
-        except Exception as e:
-            logger.error("Error generating device %s in Azure IoT Hub: %s", device_id, e)
-            raise HTTPException(status_code=500, detail="Azure IoT Hub error")
+    device_ids = [f"simdevice{(i+1):04d}" for i in range(number_of_devices)]
+    try:
+        await create_devices_bulk(device_ids)
+        logger.info("Generated %d devices in Azure IoT Hub", len(device_ids))
+    except Exception as e:
+        logger.error("Error generating devices in Azure IoT Hub: %s", e)
+        raise HTTPException(status_code=500, detail="Azure IoT Hub error")
 
-        db.add(DeviceId(device_id=device_id))
-        try:
-            await db.flush()
-            logger.info("Device ID %s saved to DB", device_id)
-        except Exception as e:
-            logger.error("Error saving device ID %s to DB: %s", device_id, e)
-            raise HTTPException(status_code=500, detail="Database error")
-        try:
-            await db.commit()
-            logger.info("Database commit successful for device %s", device_id)
-        except Exception as e:
-            await db.rollback()
-            logger.error("Error during database commit for device %s: %s", device_id, e)
-            raise HTTPException(status_code=500, detail="Database commit error")
+    try:
+        # re-running generation only adds the rows that aren't in the table yet
+        result = await db.execute(sa.select(DeviceId.device_id).where(DeviceId.device_id.in_(device_ids)))
+        existing = set(result.scalars())
+        db.add_all([DeviceId(device_id=device_id) for device_id in device_ids if device_id not in existing])
+        await db.commit()
+        logger.info("Saved %d new device IDs to DB (%d already present)", len(device_ids) - len(existing), len(existing))
+    except Exception as e:
+        await db.rollback()
+        logger.error("Error saving device IDs to DB: %s", e)
+        raise HTTPException(status_code=500, detail="Database error")
 
-    return JSONResponse({"generated_device_ids": device_ids})
+    return ORJSONResponse({"generated_device_ids": device_ids})
 
 @app.post("/delete_device/{device_id}", status_code=status.HTTP_200_OK)
 async def delete_device(device_id: str, db: AsyncSession = Depends(get_db)):
     try:
-        delete_device_credential(device_id)
+        await asyncio.to_thread(delete_device_credential, device_id)
         logger.info("Deleted device %s from Azure IoT Hub", device_id)
     except Exception as e:
         logger.error("Error deleting device %s from Azure IoT Hub: %s", device_id, e)
         raise HTTPException(status_code=500, detail="Azure IoT Hub deletion error")
     try:
-        result = await db.execute(
-            "DELETE FROM device_ids WHERE device_id = :device_id",
-            {"device_id": device_id}
-        )
+        result = await db.execute(sa.delete(DeviceId).where(DeviceId.device_id == device_id))
         if result.rowcount == 0:
+            await db.rollback()
             logger.warning("Device ID %s not found in DB", device_id)
             raise HTTPException(status_code=404, detail="Device ID not found in DB")
         await db.commit()
         logger.info("Deleted device ID %s from DB", device_id)
+    except HTTPException:
+        raise
     except Exception as e:
         await db.rollback()
         logger.error("Error deleting device ID %s from DB: %s", device_id, e)
         raise HTTPException(status_code=500, detail="Database deletion error")
-    return JSONResponse({"deleted_device_id": device_id})
+    return ORJSONResponse({"deleted_device_id": device_id})
 
 @app.post("/delete_all_devices", status_code=status.HTTP_200_OK)
 async def delete_all_devices(db: AsyncSession = Depends(get_db)):
@@ -307,14 +750,19 @@ async def delete_all_devices(db: AsyncSession = Depends(get_db)):
         for i in range(1000):
             device_ids.append(f"simdevice{(i+1):04d}")
 
-    # delete in Azure IoT Hub; handle per-device errors and continue
-    for device_id in device_ids:
-        try:
-            delete_device_credential(device_id)
+    # delete in Azure IoT Hub, IOT_MAX_CONCURRENT_REQUESTS at a time; per-device errors don't stop the rest
+    sem = asyncio.Semaphore(IOT_MAX_CONCURRENT_REQUESTS)
+
+    async def delete_one(device_id: str):
+        async with sem:
+            await asyncio.to_thread(delete_device_credential, device_id)
+
+    results = await asyncio.gather(*(delete_one(device_id) for device_id in device_ids), return_exceptions=True)
+    for device_id, result in zip(device_ids, results):
+        if isinstance(result, BaseException):
+            logger.error("Failed to delete device %s from Azure IoT Hub: %s", device_id, result)
+        else:
             logger.info("Deleted device %s from Azure IoT Hub", device_id)
-        except Exception as e:
-            logger.error("Failed to delete device %s from Azure IoT Hub: %s", device_id, e)
-            # continue with next device
 
     # remove all entries from DB (use SQLAlchemy delete expression)
     try:
@@ -325,94 +773,80 @@ async def delete_all_devices(db: AsyncSession = Depends(get_db)):
         await db.rollback()
         logger.error("Error deleting all device IDs from DB: %s", e)
         raise HTTPException(status_code=500, detail="Database deletion error")
-    return JSONResponse({"status": "all devices deleted"})
+    return ORJSONResponse({"status": "all devices deleted"})
 
 @app.post("/clear_mappings", status_code=status.HTTP_200_OK)
 async def clear_mappings(db: AsyncSession = Depends(get_db)):
     try:
-        await db.execute(
-            sa.text("UPDATE deviceids SET device_uuid = NULL")
-        )
+        await db.execute(CLEAR_MAPPINGS_SQL)
         await db.commit()
         logger.info("Cleared all device ID to UUID mappings in DB")
     except Exception as e:
         await db.rollback()
         logger.error("Error clearing device ID to UUID mappings in DB: %s", e)
         raise HTTPException(status_code=500, detail="Database update error")
-    return JSONResponse({"status": "all mappings cleared"})
+    return ORJSONResponse({"status": "all mappings cleared"})
 
 # REST API: 전체 클라이언트에 브로드캐스트 명령
 @app.post("/command/broadcast")
 async def broadcast_command(request: Request):
-    body = await request.json()
+    body = orjson.loads(await request.body())
     logger.info("Broadcasting command to all clients: %s", body)
     await manager.broadcast(body)
     logger.info("Broadcast command sent to all clients")
-    return JSONResponse({"status": "broadcasted"})
+    return ORJSONResponse({"status": "broadcasted"})
 
 # REST API: 서버 관리자가 명령을 내림
 @app.post("/command/{uuid}")
 async def send_command(uuid: str, request: Request):
-    body = await request.json()
+    body = orjson.loads(await request.body())
     # 예: {"action": "start", "iot_hub_connection_string": "...", "initial_retry_timeout": 30, "max_retry": 10}
     await manager.send_command(uuid, body)
-    return JSONResponse({"status": "sent", "uuid": uuid})
+    return ORJSONResponse({"status": "sent", "uuid": uuid})
 
 # REST API: 클라이언트가 상태/결과를 보고
-@app.post("/report/{device_id}")
-async def report_status(device_id: str, request: Request, db: AsyncSession = Depends(get_db)):
-    body = await request.json()
-    logger.info("Report from %s: %s", device_id, body)
+@app.post("/report/{device_id}", status_code=status.HTTP_202_ACCEPTED)
+async def report_status(device_id: str, request: Request):
+    body = orjson.loads(await request.body())
+    logger.debug("Report from %s: %s", device_id, body)
     # Convert body to dictionary
     data = dict(body)
-    deviceid=data.get("deviceId", "")
-    type=data.get("Type", "")
-    modelid=data.get("modelId", "")
-    status=data.get("Status", "")
-    temp=data.get("temp", 20)
-    humidity=data.get("Humidity", 50)
-    ts=data.get("ts","")           
-    try:
-        result = await db.execute(
-            sa.text("INSERT INTO telemetries (deviceid, type, modelid, status, temp, humidity, ts) VALUES (:device_id, :type, :modelid, :status, :temp, :humidity, :ts)"),
-            {"device_id": deviceid, "type": type, "modelid": modelid, "status": status, "temp": temp, "humidity": humidity, "ts": ts}
-    )
-        await db.commit()
-        logger.info("Report from %s saved to telemetries table", device_id)
-    except Exception as e:
-        await db.rollback()
-        logger.error("Error saving report from %s to telemetries table: %s", device_id, e)
-        raise HTTPException(status_code=500, detail="Database error") from e
-    # Response to client with success status
-    return JSONResponse({"status": "saved", "device_id": device_id})
+    # Rows are written in batches by telemetry_writer
+    await telemetry_queue.put({
+        "device_id": data.get("deviceId", ""),
+        "type": data.get("Type", ""),
+        "modelid": data.get("modelId", ""),
+        "status": data.get("Status", ""),
+        "temp": data.get("temp", 20),
+        "humidity": data.get("Humidity", 50),
+        "ts": data.get("ts", ""),
+    })
+    # Response to client with queued status
+    return ORJSONResponse({"status": "queued", "device_id": device_id}, status_code=status.HTTP_202_ACCEPTED)
 
 # REST API: 현재 연결된 클라이언트 목록 조회
 @app.get("/clients")
-def get_clients():
-    return {"connected_clients": list(manager.active_connections.keys())}
+async def get_clients(request: Request):
+    etag, body = await manager.clients_response()
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in (t.strip() for t in if_none_match.split(","))):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
 
 # API 헬스체크 엔드포인트
 @app.get("/api/health")
 async def api_health(request: Request):
-    return JSONResponse({"status": "ok"}, 200)  # call FastAPI health handler
+    return ORJSONResponse({"status": "ok"}, 200)  # call FastAPI health handler
 
 async def assign_device_id(message_id: str, db: AsyncSession = Depends(get_db)) -> str:
-    # Query the device_id in asc in DeviceId table where device_uuid is not assigned yet and 
-    # assign the device_id with device_uuid = message_id in this row by updating the row.
-    # Return the assigned device_id.
-    
-    result = await db.execute(
-        sa.text("SELECT device_id FROM deviceids WHERE device_uuid IS NULL ORDER BY device_id ASC LIMIT 1")
-    )
+    # Claim the lowest unassigned device_id for message_id in a single statement.
+    # FOR UPDATE SKIP LOCKED keeps concurrent claims from picking the same row.
+    result = await db.execute(CLAIM_DEVICE_ID_SQL, {"message_id": message_id})
     row = result.first()
     if row is None:
+        await db.rollback()
         raise HTTPException(status_code=404, detail="No available device IDs to assign")
     device_id = row[0]
-    # Update the row to set device_uuid
-    await db.execute(
-        sa.text("UPDATE deviceids SET device_uuid = :message_id WHERE device_id = :device_id"),
-        {"message_id": message_id, "device_id": device_id}
-    )
     await db.commit()
     logger.info("Assigned device_id %s to message_id %s", device_id, message_id)
     return device_id
@@ -426,11 +860,20 @@ async def assign_device_id(message_id: str, db: AsyncSession = Depends(get_db))
 if __name__ == "__main__":
     # Reload disabled to avoid continuous log file detection by watchfiles
     # For development with auto-reload, use: uvicorn iot_simulator_server:app --reload --reload-exclude 'logs/**'
+    # uvloop/httptools replace the stdlib asyncio loop and pure-Python HTTP parser (pip install uvloop httptools)
     uvicorn.run(
         "iot_simulator_server:app", 
         host="0.0.0.0", 
         port=5555, 
-        reload=False
+        reload=False,
+        # more than one worker requires REDIS_URL so commands reach every worker's sockets
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_max_size=1024 * 1024,  # envelopes are small; reject oversized frames early
+        ws_ping_interval=20.0,
+        ws_ping_timeout=20.0,
     )
 
 
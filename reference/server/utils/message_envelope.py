@@ -1,36 +1,51 @@
 from __future__ import annotations
-import uuid
+import time
 from datetime import datetime, timezone
-from typing import Any, Dict, Optional
-import json
+from typing import Any, Dict, Optional, Union
+import msgspec
+from msgspec import UNSET, UnsetType
+from utils.urandom_pool import uuid4_str
 
-ISO_FMT = "%Y-%m-%dT%H:%M:%SZ"
+# (epoch second, formatted timestamp) of the last iso_now() call
+_iso_cache: tuple[int, str] = (-1, "")
 
 def iso_now() -> str:
-    return datetime.now(timezone.utc).strftime(ISO_FMT)
+    # timestamps have second resolution, so format at most once per second
+    global _iso_cache
+    second = int(time.time())
+    cached_second, cached = _iso_cache
+    if second == cached_second:
+        return cached
+    n = datetime.fromtimestamp(second, timezone.utc)
+    cached = f"{n.year:04d}-{n.month:02d}-{n.day:02d}T{n.hour:02d}:{n.minute:02d}:{n.second:02d}Z"
+    _iso_cache = (second, cached)
+    return cached
 
-class MessageEnvelope:
-    def __init__(
-        self,
-        action: str,
-        type: str = "command",
-        payload: Optional[Dict[str, Any]] = None,
-        status: Optional[str] = None,
-        correlationId: Optional[str] = None,
-        meta: Optional[Dict[str, Any]] = None,
-        version: int = 1,
-        id: Optional[str] = None,
-        ts: Optional[str] = None,
-    ):
-        self.version = version
-        self.type = type
-        self.id = id or str(uuid.uuid4())
-        self.correlationId = correlationId or self.id
-        self.ts = ts or iso_now()
-        self.action = action
-        self.status = status
-        self.payload = payload or {}
-        self.meta = meta or {}
+class MessageEnvelope(msgspec.Struct):
+    """Wire envelope; encoded straight to JSON by msgspec without an intermediate dict.
+
+    status is UNSET (and left out of the JSON) unless one is given.
+    """
+    action: str
+    type: str = "command"
+    payload: Optional[Dict[str, Any]] = None
+    status: Union[str, None, UnsetType] = UNSET
+    correlationId: Optional[str] = None
+    meta: Optional[Dict[str, Any]] = None
+    version: int = 1
+    id: Optional[str] = None
+    ts: Optional[str] = None
+
+    def __post_init__(self):
+        self.id = self.id or uuid4_str()
+        self.correlationId = self.correlationId or self.id
+        self.ts = self.ts or iso_now()
+        if self.status is None:
+            self.status = UNSET
+        if self.payload is None:
+            self.payload = {}
+        if self.meta is None:
+            self.meta = {}
 
     def to_dict(self) -> Dict[str, Any]:
         d: Dict[str, Any] = {
@@ -43,12 +58,18 @@ class MessageEnvelope:
             "payload": self.payload,
             "meta": self.meta,
         }
-        if self.status is not None:
+        if self.status is not UNSET:
             d["status"] = self.status
         return d
 
-    def to_json(self, **kwargs) -> str:
-        return json.dumps(self.to_dict(), **kwargs)
+    def to_json(self) -> str:
+        return self.to_json_bytes().decode()
+
+    def to_json_bytes(self) -> bytes:
+        return _encoder.encode(self)
+
+    def to_msgpack(self) -> bytes:
+        return _msgpack_encoder.encode(self)
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> "MessageEnvelope":
@@ -63,3 +84,6 @@ class MessageEnvelope:
             id=data.get("id"),
             ts=data.get("ts"),
         )
+
+_encoder = msgspec.json.Encoder()
+_msgpack_encoder = msgspec.msgpack.Encoder()
@@ -0,0 +1,46 @@
+from __future__ import annotations
+import os
+import threading
+
+POOL_SIZE = 4096
+
+class UrandomPool:
+    """Hands out os.urandom bytes from a buffer refilled POOL_SIZE bytes at a time."""
+    __slots__ = ("buf", "pos")
+
+    def __init__(self):
+        self.buf = b""
+        self.pos = 0
+
+    def take(self, n: int) -> bytes:
+        pos = self.pos
+        end = pos + n
+        if end > len(self.buf):
+            self.buf = os.urandom(max(POOL_SIZE, n))
+            pos, end = 0, n
+        self.pos = end
+        return self.buf[pos:end]
+
+# one pool per thread so concurrent callers never slice the same bytes
+_local = threading.local()
+
+def _reset_after_fork() -> None:
+    # a forked child must not hand out bytes its parent already used
+    global _local
+    _local = threading.local()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def urandom(n: int) -> bytes:
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = UrandomPool()
+    return pool.take(n)
+
+def uuid4_str() -> str:
+    # same format as str(uuid.uuid4()), without a syscall or UUID object per id
+    b = bytearray(urandom(16))
+    b[6] = (b[6] & 0x0F) | 0x40  # version 4
+    b[8] = (b[8] & 0x3F) | 0x80  # RFC 4122 variant
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"